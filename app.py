@@ -5,14 +5,44 @@ multi-agent system to solve wordy math problems with
 unreliable sum/product and virtual tool caching.
 """
 #%%
+import asyncio
+import threading
 import streamlit as st
 from multi_agent_toolbox import ask_system
 
+@st.cache_resource
+def _background_loop() -> asyncio.AbstractEventLoop:
+    """
+    One event loop, on a daemon thread, shared by every session.
+    Each session's ask_system runs on it, so concurrent users' LLM calls
+    overlap, and the module's semaphore always sees the same loop.
+    """
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, name="ask-system-loop", daemon=True).start()
+    return loop
+
+class _NotCached(Exception):
+    """Carries a result out of _cached_ask without caching it."""
+
+@st.cache_data(show_spinner=False, ttl=3600)
+def _cached_ask(question: str) -> dict:
+    """
+    ask_system, memoized per question text for an hour, so clicking
+    "Solve" again on the same text doesn't re-run the pipeline.
+    Only virtual-tool answers are cached: fresh answers must keep reaching
+    ask_system, whose success count is what memoizes them in the first place.
+    """
+    future = asyncio.run_coroutine_threadsafe(ask_system(question), _background_loop())
+    result = future.result()
+    if result["status"] != "success" or result["via"] != "virtual_tool":
+        raise _NotCached(result)
+    return result
+
 def main():
     st.title("Multi-Agent Math System (Streamlit UI)")
     st.write("""
-    This app uses a multi-turn LLM approach to discover tools 
-    (without a single big prompt), executes a plan for your math question, 
+    This app asks an LLM planner (given short docs for every tool) 
+    for a plan, executes it for your math question, 
     and eventually caches repeated solutions as 'virtual tools.'
     """)
 
@@ -21,7 +51,10 @@ def main():
 
     if st.button("Solve"):
         with st.spinner("Thinking..."):
-            result = ask_system(user_question)
+            try:
+                result = _cached_ask(user_question)
+            except _NotCached as e:
+                result = e.args[0]
 
         # Display result
         st.subheader("Result")
@@ -2,13 +2,15 @@
 """
 Multi-turn LLM + Virtual Tool Memoization
 -----------------------------------------
-- No single prompt or mega-string enumerating all tools:
-  Each tool doc is stored in separate small variables.
-- If a user question is "similar" (in this MVP: exact match),
-  we reuse a memoized plan from last time => "virtual tool".
+- Each tool doc is stored in a separate small variable; together
+  they are short enough to inline in the system prompt, so the
+  planner usually answers with the final plan in one call.
+- If a user question is "similar" (exact match, or a close embedding
+  match when fastembed is installed), we reuse a memoized plan from
+  last time => "virtual tool".
 - Only SUM/PRODUCT are unreliable. Others are reliable.
-- The LLM can discover the tools in a multi-turn conversation,
-  asking "Which tools exist?" or "Tell me about the tool named X."
+- If the LLM still asks "Which tools exist?" or "Tell me about the
+  tool named X.", we fall back to a multi-turn discovery conversation.
 - If the plan is successful multiple times, we store it as a
   new "virtual tool" for that user question signature.
 
@@ -16,14 +18,47 @@ Usage:
   python multi_agent_toolbox.py
 """
 #%%
-import openai
+import asyncio
 import json
-import random
 import os
-from typing import Dict, Any
+import re
+import sqlite3
+from functools import lru_cache
+from typing import Callable, Dict, List, Optional, Tuple, Union
 
-# Possibly set your API key (or rely on environment variable):
-openai.api_key = os.environ.get("OPENAI_API_KEY")
+import numpy as np
+from openai import AsyncOpenAI
+
+try:
+    # Optional: enables semantic (paraphrase) lookup of virtual tools.
+    from fastembed import TextEmbedding
+except ImportError:
+    TextEmbedding = None
+
+try:
+    # Optional: faster plan parsing; its errors subclass ValueError too.
+    from orjson import loads as _json_loads
+except ImportError:
+    _json_loads = json.loads
+
+# The client reads OPENAI_API_KEY. It is created on the first LLM call, so
+# the module (and the fast_plan / virtual-tool paths) work without a key.
+_client: Optional[AsyncOpenAI] = None
+
+def get_client() -> AsyncOpenAI:
+    """The shared AsyncOpenAI client, created on first use."""
+    global _client
+    if _client is None:
+        _client = AsyncOpenAI(api_key=os.environ.get("OPENAI_API_KEY"))
+    return _client
+
+# Cap on in-flight chat completions, so fanning out many questions
+# at once stays within the API rate limits.
+MAX_CONCURRENT_REQUESTS = 50
+_llm_slots = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+
+# Most virtual tools (and success counts) kept; also sizes the plan parse cache.
+MAX_VIRTUAL_TOOLS = 10_000
 
 #%%
 ###############################################################################
@@ -36,19 +71,36 @@ DOC_QUOTIENT = "QUOTIENT: reliable a/b. (error if b=0)."
 DOC_MODULO   = "MODULO: reliable a%b. (error if b=0)."
 DOC_POWER    = "POWER: reliable a**b."
 DOC_ABS      = "ABS: reliable absolute(a). Takes [a], ignoring b."
+
+# All docs joined once at import; ~150 tokens, cheap to send up front.
+TOOL_DOCS = "\n".join([
+    DOC_SUM, DOC_PRODUCT, DOC_DELTA, DOC_QUOTIENT, DOC_MODULO, DOC_POWER, DOC_ABS,
+])
 #%%
 ###############################################################################
 # 2) The Actual Tool Functions
 ###############################################################################
-def unreliable_sum(a: float, b: float, fail_rate=0.4) -> float:
-    if random.random() < fail_rate:
-        return random.randint(-100, 100)
+# Randomness for the unreliable tools. execute_plan draws one uniform float
+# and one junk integer per step up front, in two numpy calls, instead of
+# hitting the RNG inside every tool call.
+_rng = np.random.default_rng()
+
+def seed_tools(seed: Optional[int] = None):
+    """Reseed the unreliable tools' RNG (e.g. for reproducible runs)."""
+    global _rng
+    _rng = np.random.default_rng(seed)
+
+def unreliable_sum(a: float, b: float, r: float, junk: int, fail_rate=0.4) -> float:
+    """r is a pre-drawn uniform [0,1) float; junk is returned on failure."""
+    if r < fail_rate:
+        return junk
     else:
         return a + b
 
-def unreliable_product(a: float, b: float, fail_rate=0.4) -> float:
-    if random.random() < fail_rate:
-        return random.randint(-100, 100)
+def unreliable_product(a: float, b: float, r: float, junk: int, fail_rate=0.4) -> float:
+    """r is a pre-drawn uniform [0,1) float; junk is returned on failure."""
+    if r < fail_rate:
+        return junk
     else:
         return a * b
 
@@ -71,22 +123,26 @@ def power(a: float, b: float) -> float:
 def absolute(a: float) -> float:
     return abs(a)
 
-def verify_unreliable(tool_name: str, a: float, b: float, candidate: float) -> bool:
-    t = tool_name.upper()
-    if t == "SUM":
-        return (candidate == (a + b))
-    elif t == "PRODUCT":
-        return (candidate == (a * b))
-    return True  # other tools are reliable anyway
+# Tool table: tool name => (function, arity).
+# SUM and PRODUCT also take the step's pre-drawn (r, junk) pair; they are
+# special-cased in execute_compiled, every other tool is called from here.
+TOOLS: Dict[str, Tuple[Callable[..., float], int]] = {
+    "SUM":      (unreliable_sum,     2),
+    "PRODUCT":  (unreliable_product, 2),
+    "DELTA":    (delta,              2),
+    "QUOTIENT": (quotient,           2),
+    "MODULO":   (modulo,             2),
+    "POWER":    (power,              2),
+    "ABS":      (absolute,           1),
+}
 #%%
 ###############################################################################
-# 3) Minimal System Prompt (No big listing of all tools)
+# 3) System Prompt (every tool doc inlined, so no discovery round-trips)
 ###############################################################################
 SYSTEM_PROMPT = """\
-You are a Planner LLM. You do NOT know which tools exist.
-You may ask: "Which tools exist?" 
-OR "Tell me about the tool named 'XYZ'" to discover them one by one.
-Once you have enough info, produce a final JSON plan:
+You are a Planner LLM. These are the available tools:
+""" + TOOL_DOCS + """
+Produce a final JSON plan:
 {
   "steps": [
     {"tool":"...", "args":[...]}, 
@@ -94,38 +150,95 @@ Once you have enough info, produce a final JSON plan:
   ],
   "final_step_index": <index>
 }
-No extra text, just the final JSON when done.
+Output only the final JSON, no extra text.
 """
+
+# Shared message prefix for every planner conversation. Built once, so each
+# request starts with byte-identical system content, which is what lets
+# OpenAI's automatic prompt caching reuse it. Never mutated.
+_SYS_MSGS = ({"role": "system", "content": SYSTEM_PROMPT},)
 #%%
 ###############################################################################
-# 4) Multi-turn conversation with the LLM (Planner)
+# 4) Conversation with the LLM (Planner)
 ###############################################################################
-def conversation_with_planner(user_question: str) -> str:
+async def stream_reply(messages: List[dict]) -> str:
+    """
+    Stream one completion and return its text.
+    The plan JSON is the last thing the model writes, so as soon as a
+    top-level {...} containing "final_step_index" closes we return just
+    that object and close the stream, which also aborts the rest of the
+    generation. Braces inside JSON strings are not counted. Other replies
+    are returned whole.
     """
-    We'll loop calls to openai.ChatCompletion until:
-     - The LLM yields a JSON with "steps" & "final_step_index"
+    buf: List[str] = []
+    seen = 0     # chars in buf so far
+    depth = 0
+    start = -1   # offset of the current top-level "{"
+    in_str = escaped = False
+    async with _llm_slots:
+        stream = await get_client().chat.completions.create(
+            model="gpt-3.5-turbo",
+            messages=messages,
+            temperature=0.0,
+            stream=True
+        )
+        try:
+            async for chunk in stream:
+                if not chunk.choices:
+                    continue
+                piece = chunk.choices[0].delta.content
+                if not piece:
+                    continue
+                for j, ch in enumerate(piece):
+                    if in_str:
+                        if escaped:
+                            escaped = False
+                        elif ch == "\\":
+                            escaped = True
+                        elif ch == '"':
+                            in_str = False
+                    elif ch == '"' and depth > 0:
+                        in_str = True
+                    elif ch == "{":
+                        if depth == 0:
+                            start = seen + j
+                        depth += 1
+                    elif ch == "}" and depth > 0:
+                        depth -= 1
+                        if depth == 0:
+                            obj = ("".join(buf) + piece[:j+1])[start:]
+                            if '"final_step_index"' in obj:
+                                return obj
+                buf.append(piece)
+                seen += len(piece)
+        finally:
+            await stream.close()
+    return "".join(buf).strip()
+
+async def conversation_with_planner(user_question: str) -> Tuple[str, dict]:
+    """
+    Returns the plan JSON text and its parsed dict.
+    Since the system prompt carries every tool doc, the first reply is
+    normally the final JSON (with "steps" & "final_step_index") and we
+    return after one call. Otherwise we keep the conversation going:
     If it asks "Which tools exist?" we give minimal list.
     If "Tell me about the tool named X," we give doc snippet for X only.
     """
-    messages = [
-        {"role": "system", "content": SYSTEM_PROMPT},
-        {"role": "user", "content": user_question}
-    ]
+    messages = [*_SYS_MSGS, {"role": "user", "content": user_question}]
 
     while True:
-        resp = openai.ChatCompletion.create(
-            model="gpt-3.5-turbo",
-            messages=messages,
-            temperature=0.0
-        )
-        content = resp.choices[0].message["content"].strip()
-        role    = resp.choices[0].message["role"]
+        content = await stream_reply(messages)
+        role    = "assistant"
 
-        # Check for final JSON
-        if '"steps":' in content and '"final_step_index":' in content:
-            return content  # done
+        # Check for final JSON (one parse; the plan is handed on as-is)
+        try:
+            plan = _json_loads(content)
+        except ValueError:
+            plan = None
+        if isinstance(plan, dict) and "steps" in plan and "final_step_index" in plan:
+            return content, plan  # done
 
-        # else, it might ask about tools
+        # else, fall back to discovery: it might ask about tools
         messages.append({"role": role, "content": content})
         lower_content = content.lower()
 
@@ -147,109 +260,421 @@ def conversation_with_planner(user_question: str) -> str:
                 "content": "If you need more tool docs, ask specifically. Otherwise, produce the final JSON plan."
             })
 
+_TOOL_RE = re.compile(r"\b(sum|product|delta|quotient|modulo|power|abs)\b")
+
+_DOCS = {
+    "sum":      DOC_SUM,
+    "product":  DOC_PRODUCT,
+    "delta":    DOC_DELTA,
+    "quotient": DOC_QUOTIENT,
+    "modulo":   DOC_MODULO,
+    "power":    DOC_POWER,
+    "abs":      DOC_ABS,
+}
+
 def parse_tool_request(text: str) -> str:
-    for t in ["sum","product","delta","quotient","modulo","power","abs"]:
-        if t in text:
-            return t
-    return ""
+    m = _TOOL_RE.search(text)
+    return m.group(1) if m else ""
 
 def get_tool_doc(tool_name: str) -> str:
-    if tool_name == "sum":      return DOC_SUM
-    if tool_name == "product":  return DOC_PRODUCT
-    if tool_name == "delta":    return DOC_DELTA
-    if tool_name == "quotient": return DOC_QUOTIENT
-    if tool_name == "modulo":   return DOC_MODULO
-    if tool_name == "power":    return DOC_POWER
-    if tool_name == "abs":      return DOC_ABS
-    return "No such tool."
+    return _DOCS.get(tool_name, "No such tool.")
+#%%
+###############################################################################
+# 4b) Rule-based planner for templated questions (no LLM)
+###############################################################################
+# Each pattern must match the whole (normalized) question, so anything with
+# extra clauses falls through to the LLM. Builders return the plan steps;
+# like the LLM planner, chained steps carry the previous result as a literal.
+###############################################################################
+_N = r"(-?\d+(?:\.\d+)?)"
+_END = r"\s*[.?!]?$"
+
+def _lit(x: float):
+    """Render a number the way the LLM would: 8, not 8.0."""
+    return int(x) if x.is_integer() else x
+
+def _diff_then_product(a, b, c):
+    return [("DELTA", [b, a]), ("PRODUCT", [a - b, c])]
+
+def _combine_then_multiply(a, b, c):
+    return [("SUM", [a, b]), ("PRODUCT", [a + b, c])]
+
+def _abs_then_sum(a, b):
+    return [("ABS", [a]), ("SUM", [abs(a), b])]
+
+def _single(tool):
+    return lambda a, b: [(tool, [a, b])]
+
+_FAST_PATTERNS = [
+    (re.compile(r"^(?:compute |find )?(?:the )?difference (?:of|between) " + _N + r" and " + _N
+                + r",? then (?:do )?(?:the )?(?:product|multiply) (?:with|by) " + _N + _END),
+     _diff_then_product),
+    # at most one unit word after each count ("3 apples"): anything longer,
+    # such as "5 times as many" or a third person, goes to the LLM
+    (re.compile(r"^[a-z]+ has " + _N + r"(?: [a-z]+)?, [a-z]+ has " + _N + r"(?: [a-z]+)?\.\s*"
+                r"combine them,? then multiply (?:the total|it) by " + _N + _END),
+     _combine_then_multiply),
+    (re.compile(r"^(?:compute |find )?(?:the )?absolute (?:value )?of " + _N
+                + r",? then (?:sum|add) " + _N + r"(?: to (?:that|the) result)?" + _END),
+     _abs_then_sum),
+    (re.compile(r"^(?:what is |compute |find )?(?:the )?sum of " + _N + r" and " + _N + _END),
+     _single("SUM")),
+    (re.compile(r"^(?:what is |compute |find )?(?:the )?product of " + _N + r" and " + _N + _END),
+     _single("PRODUCT")),
+]
+
+def fast_plan(signature: str) -> Optional[str]:
+    """
+    Plan JSON for a question matching one of _FAST_PATTERNS, else None.
+    Takes the normalized question (see get_question_signature).
+    """
+    for pattern, build in _FAST_PATTERNS:
+        m = pattern.match(signature)
+        if m:
+            nums = [float(g) for g in m.groups()]
+            steps = build(*nums)
+            return json.dumps({
+                "steps": [{"tool": t, "args": [_lit(x) for x in args]} for t, args in steps],
+                "final_step_index": len(steps) - 1,
+            })
+    return None
 #%%
 ###############################################################################
 # 5) Execute the final plan
 ###############################################################################
-def execute_plan(plan_text: str) -> float:
-    plan = json.loads(plan_text)  # might raise JSONDecodeError
-    steps = plan.get("steps", [])
+# A compiled plan: ((TOOL, float args), ...) plus the final step index.
+CompiledSteps = Tuple[Tuple[str, Tuple[float, ...]], ...]
+CompiledPlan  = Tuple[CompiledSteps, int]
+
+@lru_cache(maxsize=MAX_VIRTUAL_TOOLS)
+def _parse_plan(plan_text: str) -> CompiledPlan:
+    """
+    Parse and compile plan JSON. The result is immutable and memoized,
+    so replaying the same plan_text skips parsing and float() entirely.
+    """
+    plan = _json_loads(plan_text)  # might raise JSONDecodeError
+    return _compile_plan(plan)
+
+def _compile_plan(plan: dict) -> CompiledPlan:
+    """
+    Compile a parsed plan: tool names are upper-cased and checked,
+    args are cut to the tool's arity and coerced to float.
+    """
+    steps = []
+    for i, stp in enumerate(plan.get("steps", [])):
+        tool = stp.get("tool","").upper()
+        args = stp.get("args", [])
+        if tool not in TOOLS:
+            raise ValueError(f"Unknown tool '{tool}' at step {i}")
+        arity = TOOLS[tool][1]
+        if len(args) < arity:
+            raise ValueError(f"{tool} needs {arity} args")
+        steps.append((tool, tuple(float(x) for x in args[:arity])))
     final_idx = plan.get("final_step_index", len(steps)-1)
     if final_idx >= len(steps):
         raise ValueError("invalid final_step_index")
+    return tuple(steps), final_idx
+
+def execute_compiled(steps: CompiledSteps, final_idx: int) -> float:
+    """
+    Run an already compiled plan (see _compile_plan). Compilation already
+    checked tool names and arity, so steps are dispatched without checks.
+    """
+    draws = _rng.random(len(steps)).tolist()
+    junk  = _rng.integers(-100, 101, size=len(steps)).tolist()
 
     results = []
-    for i, stp in enumerate(steps):
-        tool = stp.get("tool","").upper()
-        args = stp.get("args", [])
-        if tool == "SUM":
-            if len(args)<2: raise ValueError("SUM needs 2 args")
-            a, b = float(args[0]), float(args[1])
-            out = unreliable_sum(a,b)
-            if not verify_unreliable("SUM", a,b, out):
-                out = a+b
-        elif tool=="PRODUCT":
-            if len(args)<2: raise ValueError("PRODUCT needs 2 args")
-            a, b = float(args[0]), float(args[1])
-            out = unreliable_product(a,b)
-            if not verify_unreliable("PRODUCT", a,b, out):
-                out = a*b
-        elif tool=="DELTA":
-            a, b = float(args[0]), float(args[1])
-            out = delta(a,b)
-        elif tool=="QUOTIENT":
-            a, b = float(args[0]), float(args[1])
-            out = quotient(a,b)
-        elif tool=="MODULO":
-            a, b = float(args[0]), float(args[1])
-            out = modulo(a,b)
-        elif tool=="POWER":
-            a, b = float(args[0]), float(args[1])
-            out = power(a,b)
-        elif tool=="ABS":
-            a = float(args[0])
-            out = absolute(a)
-        else:
-            raise ValueError(f"Unknown tool '{tool}' at step {i}")
+    for i, (tool, vals) in enumerate(steps):
+        # The unreliable tools are matched first, with their correct result
+        # computed inline; the reliable ones go through the TOOLS table.
+        match tool:
+            case "SUM":
+                a, b = vals
+                truth = a + b
+                out = unreliable_sum(a, b, draws[i], junk[i])
+                if out != truth:
+                    out = truth
+            case "PRODUCT":
+                a, b = vals
+                truth = a * b
+                out = unreliable_product(a, b, draws[i], junk[i])
+                if out != truth:
+                    out = truth
+            case _:
+                out = TOOLS[tool][0](*vals)
 
         results.append(out)
 
     return float(results[final_idx])
+
+def execute_plan(plan_text: str, plan: Optional[dict] = None) -> float:
+    """Run plan JSON; pass its parsed dict as `plan` to skip parsing it."""
+    if plan is not None:
+        return execute_compiled(*_compile_plan(plan))
+    return execute_compiled(*_parse_plan(plan_text))
 #%%
 ###############################################################################
 # 6) Virtual Tools Caching / Memoization
 ###############################################################################
-# We'll store a plan for each question signature after 2 successful uses
-# In a real system, you'd do a more semantic approach
+# We'll store a plan for each question signature after 2 successful uses.
+# Plans and success counts live in SQLite, so memoized virtual tools
+# survive restarts. Exact-match lookups and counts are shared by every
+# worker on the same database; the semantic index is loaded at import,
+# so each process only finds other workers' plans semantically after a
+# restart.
+# Lookup tries the exact signature first, then (if fastembed is available)
+# the nearest stored signature by cosine similarity, so paraphrases of a
+# memoized question reuse its plan too. Plans embed the question's numbers
+# as literals, so a semantic match also has to mention the same numbers,
+# in the same order.
+# Both tables are LRU-bounded to MAX_VIRTUAL_TOOLS rows: every use
+# re-inserts a row, which gives it the highest rowid, and inserts evict
+# the lowest rowids.
 ###############################################################################
-virtual_tools: Dict[str, Dict[str, Any]] = {}
-success_count: Dict[str, int]           = {}
+PLAN_DB_PATH = os.environ.get("VIRTUAL_TOOLS_DB", "virtual_tools.db")
+SEMANTIC_HIT_THRESHOLD = 0.88
+
+_db = sqlite3.connect(PLAN_DB_PATH, check_same_thread=False)
+_db.execute("PRAGMA journal_mode=WAL")  # readers don't block the writer
+_db.execute("PRAGMA synchronous=NORMAL")  # with WAL: no fsync per commit (e.g. per hit)
+_db.execute("""CREATE TABLE IF NOT EXISTS plans (
+    sig       TEXT PRIMARY KEY,
+    plan_text TEXT NOT NULL,
+    hits      INT  NOT NULL DEFAULT 0,
+    vec       BLOB
+)""")
+_db.execute("""CREATE TABLE IF NOT EXISTS counts (
+    sig TEXT PRIMARY KEY,
+    n   INT  NOT NULL
+)""")
+_db.commit()
+
+# Built at import rather than on first use: loading (or downloading) the
+# model takes seconds and must not happen inside a request.
+_embedder = TextEmbedding() if TextEmbedding is not None else None
+
+# Quantities written as words. Multipliers map to their factor;
+# square/cube map to an exponent token instead, so "then double" and
+# "then square it" (both "2") still differ.
+Quantity = Union[float, str]
+_WORD_QUANTITIES: Dict[str, Quantity] = {
+    "zero": 0.0, "one": 1.0, "two": 2.0, "three": 3.0, "four": 4.0, "five": 5.0,
+    "six": 6.0, "seven": 7.0, "eight": 8.0, "nine": 9.0, "ten": 10.0,
+    "half": 0.5, "halve": 0.5, "double": 2.0, "twice": 2.0, "triple": 3.0, "thrice": 3.0,
+    "quadruple": 4.0,
+    "square": "^2", "squared": "^2", "cube": "^3", "cubed": "^3",
+}
+_QTY_RE = re.compile(_N + r"|\b(" + "|".join(_WORD_QUANTITIES) + r")\b")
+
+# Semantic index: row i of _vt_matrix is the unit embedding of _vt_sigs[i],
+# and _vt_nums[i] the quantities that question mentions. The matrix has spare
+# capacity past len(_vt_sigs) rows, so adding and removing entries never
+# rebuilds it.
+_vt_sigs: List[str] = []
+_vt_nums: List[Tuple[Quantity, ...]] = []
+_vt_rows: Dict[str, int] = {}
+_vt_matrix: Optional[np.ndarray] = None
 
 def get_question_signature(question: str) -> str:
     """
-    For an MVP, we do an exact string match.
-    Real usage might do embeddings or classification.
+    Normalized form of the question, used as the exact-match key
+    and as the text we embed for semantic lookup.
     """
     return question.strip().lower()
 
-def store_virtual_tool(signature: str, plan_text: str):
-    """Store the plan in a dictionary so next time we skip LLM."""
-    virtual_tools[signature] = {
-        "plan_text": plan_text,
-        # you might store time created, usage stats, etc.
-    }
+def embed_signature(signature: str) -> Optional[np.ndarray]:
+    """
+    Unit-length embedding of a signature, or None without fastembed.
+    This is blocking model inference; coroutines should run it through
+    asyncio.to_thread so it doesn't stall the event loop.
+    """
+    if _embedder is None:
+        return None
+    vec = np.asarray(next(_embedder.embed([signature])), dtype=np.float32)
+    return vec / np.linalg.norm(vec)
+
+def question_numbers(signature: str) -> Tuple[Quantity, ...]:
+    """
+    The quantities in a question, in the order they appear: numeric
+    literals and number words (see _WORD_QUANTITIES).
+    Order matters: "difference of 10 and 3" and "of 3 and 10" differ.
+    """
+    return tuple(float(num) if num else _WORD_QUANTITIES[word]
+                 for num, word in _QTY_RE.findall(signature))
+
+def _index_vector(signature: str, vec: np.ndarray):
+    global _vt_matrix
+    i = _vt_rows.get(signature)
+    if i is None:
+        i = len(_vt_sigs)
+        if _vt_matrix is None:
+            _vt_matrix = np.empty((64, vec.size), dtype=np.float32)
+        elif i == len(_vt_matrix):
+            _vt_matrix = np.concatenate([_vt_matrix, np.empty_like(_vt_matrix)])
+        _vt_rows[signature] = i
+        _vt_sigs.append(signature)
+        _vt_nums.append(question_numbers(signature))
+    _vt_matrix[i] = vec
+
+def _unindex(signature: str):
+    """Drop a signature from the semantic index (the last row fills its slot)."""
+    i = _vt_rows.pop(signature, None)
+    if i is None:
+        return
+    last = len(_vt_sigs) - 1
+    if i != last:
+        moved = _vt_sigs[last]
+        _vt_matrix[i] = _vt_matrix[last]
+        _vt_sigs[i] = moved
+        _vt_nums[i] = _vt_nums[last]
+        _vt_rows[moved] = i
+    _vt_sigs.pop()
+    _vt_nums.pop()
+
+def _load_semantic_index():
+    """Build the in-process semantic index from the stored plans."""
+    rows = _db.execute("SELECT sig, vec FROM plans WHERE vec IS NOT NULL")
+    for sig, blob in rows:
+        _index_vector(sig, np.frombuffer(blob, dtype=np.float32))
+
+@lru_cache(maxsize=1024)
+def load_virtual_tool(signature: str) -> str:
+    """
+    The memoized plan_text for a signature.
+    Raises KeyError when there is none; lru_cache doesn't cache
+    exceptions, so a plan stored later (even by another worker) is seen.
+    A cached plan stays usable in this process after another worker
+    evicts it; it is still the right plan, just no longer shared.
+    """
+    row = _db.execute(
+        "SELECT plan_text FROM plans WHERE sig=?", (signature,)
+    ).fetchone()
+    if row is None:
+        raise KeyError(signature)
+    return row[0]
+
+def has_virtual_tool(signature: str) -> bool:
+    """Whether a plan is memoized under exactly this signature."""
+    try:
+        load_virtual_tool(signature)
+        return True
+    except KeyError:
+        return False
+
+def semantic_index_ready() -> bool:
+    """Whether a semantic lookup could find anything right now."""
+    return _embedder is not None and bool(_vt_sigs)
+
+def find_similar_tool(signature: str, q: np.ndarray) -> Optional[str]:
+    """
+    Return the signature of the memoized plan most similar to this one,
+    given its embedding q (see embed_signature), or None. A match must
+    clear SEMANTIC_HIT_THRESHOLD and mention the same numbers as ours, in
+    the same order (else its plan would compute something else).
+    """
+    if not _vt_sigs:
+        return None
+    sims = _vt_matrix[:len(_vt_sigs)] @ q
+    candidates = np.flatnonzero(sims > SEMANTIC_HIT_THRESHOLD)
+    if candidates.size == 0:
+        return None
+    nums = question_numbers(signature)
+    for i in candidates[np.argsort(-sims[candidates])]:
+        if _vt_nums[i] != nums:
+            continue
+        try:
+            load_virtual_tool(_vt_sigs[i])  # may have been evicted meanwhile
+        except KeyError:
+            continue
+        return _vt_sigs[i]
+    return None
+
+def _evict_lru(table: str) -> List[str]:
+    """Drop all but the MAX_VIRTUAL_TOOLS newest rows; return their sigs."""
+    row = _db.execute(
+        f"SELECT rowid FROM {table} ORDER BY rowid DESC LIMIT 1 OFFSET ?",
+        (MAX_VIRTUAL_TOOLS,),
+    ).fetchone()
+    if row is None:
+        return []
+    doomed = [sig for (sig,) in _db.execute(
+        f"SELECT sig FROM {table} WHERE rowid <= ?", (row[0],)
+    )]
+    _db.execute(f"DELETE FROM {table} WHERE rowid <= ?", (row[0],))
+    return doomed
+
+def store_virtual_tool(signature: str, plan_text: str, vec: Optional[np.ndarray] = None):
+    """
+    Store the plan in the database so next time we skip LLM.
+    vec is the signature's embedding, if any; with it the plan can also
+    be found by find_similar_tool.
+    Compiling it here only warms the parse cache: replays still parse
+    again if the entry has since been evicted or the process restarted.
+    """
+    _parse_plan(plan_text)
+    with _db:
+        _db.execute(
+            "INSERT OR REPLACE INTO plans (sig, plan_text, hits, vec) VALUES (?, ?, 0, ?)",
+            (signature, plan_text, None if vec is None else vec.tobytes()),
+        )
+        evicted = _evict_lru("plans")
+    load_virtual_tool.cache_clear()
+    for sig in evicted:
+        _unindex(sig)
+    if vec is not None:
+        _index_vector(signature, vec)
+
+def record_virtual_tool_hit(signature: str):
+    """Bump the usage counter of a memoized plan and mark it most recent."""
+    with _db:
+        _db.execute(
+            "INSERT OR REPLACE INTO plans (sig, plan_text, hits, vec) "
+            "SELECT sig, plan_text, hits + 1, vec FROM plans WHERE sig=?",
+            (signature,),
+        )
+
+def record_success(signature: str) -> int:
+    """Count one more successful fresh plan for a signature; return the total."""
+    with _db:
+        _db.execute(
+            "INSERT OR REPLACE INTO counts (sig, n) VALUES "
+            "(?, COALESCE((SELECT n FROM counts WHERE sig=?), 0) + 1)",
+            (signature, signature),
+        )
+        _evict_lru("counts")
+        row = _db.execute("SELECT n FROM counts WHERE sig=?", (signature,)).fetchone()
+    return row[0]
+
+_load_semantic_index()
 #%%
 ###############################################################################
 # 7) ask_system => the user-facing function
 ###############################################################################
-def ask_system(wordy_question: str) -> dict:
+async def ask_system(wordy_question: str) -> dict:
     """
-    1) Check if we have a 'virtual tool' for this question signature.
-    2) If yes, run that plan, skip LLM.
-    3) If no, do multi-turn approach => get plan => run => store or increment usage
-    4) If success repeated enough => store as virtual tool
+    1) Check if we have a 'virtual tool' for exactly this question.
+    2) If not, try the rule-based fast_plan (exact and free), and only
+       if that doesn't apply look for a virtual tool of a paraphrase.
+    3) With a virtual tool, run that plan, skip LLM.
+    4) Otherwise plan it (fast_plan's plan, else with the LLM)
+       => run => store or increment usage
+    5) If success repeated enough => store as virtual tool
     """
     sig = get_question_signature(wordy_question)
-    if sig in virtual_tools:
+    hit = sig if has_virtual_tool(sig) else None
+    plan_text = None
+    vec = None
+    if hit is None:
+        plan_text = fast_plan(sig)
+        if plan_text is None and semantic_index_ready():
+            vec = await asyncio.to_thread(embed_signature, sig)
+            hit = find_similar_tool(sig, vec)
+    if hit is not None:
         # We have a memoized plan for this question
-        plan_text = virtual_tools[sig]["plan_text"]
+        plan_text = load_virtual_tool(hit)
         try:
-            val = execute_plan(plan_text)
+            val = execute_compiled(*_parse_plan(plan_text))
+            record_virtual_tool_hit(hit)
             return {
                 "question": wordy_question,
                 "plan": plan_text,
@@ -267,25 +692,31 @@ def ask_system(wordy_question: str) -> dict:
                 "via": "virtual_tool"
             }
     else:
-        # We do the multi-turn approach
-        plan_text = conversation_with_planner(wordy_question)
+        # Templated questions were planned by rule; otherwise ask the LLM
+        plan = None
+        via = "fast_plan"
+        if plan_text is None:
+            plan_text, plan = await conversation_with_planner(wordy_question)
+            via = "fresh_llm"
         try:
-            val = execute_plan(plan_text)
-            # success => increment usage
-            old_count = success_count.get(sig, 0)
-            new_count = old_count + 1
-            success_count[sig] = new_count
-
-            # if we have 2 successes => store as virtual tool
-            if new_count == 2:
-                store_virtual_tool(sig, plan_text)
+            val = execute_plan(plan_text, plan)
+            # success => increment usage, and if we have 2 successes
+            # => store as virtual tool (first time, or evicted since).
+            new_count = record_success(sig)
+            if new_count >= 2 and not has_virtual_tool(sig):
+                if vec is None and _embedder is not None:
+                    vec = await asyncio.to_thread(embed_signature, sig)
+                # Re-check: a concurrent ask may have stored it meanwhile.
+                # From here to the store nothing awaits.
+                if not has_virtual_tool(sig):
+                    store_virtual_tool(sig, plan_text, vec)
 
             return {
                 "question": wordy_question,
                 "plan": plan_text,
                 "answer": val,
                 "status": "success",
-                "via": "fresh_llm"
+                "via": via
             }
         except Exception as e:
             return {
@@ -293,28 +724,37 @@ def ask_system(wordy_question: str) -> dict:
                 "plan": plan_text,
                 "error": str(e),
                 "status": "fail",
-                "via": "fresh_llm"
+                "via": via
             }
 
+async def ask_many(questions: List[str]) -> List[dict]:
+    """
+    Run ask_system for several questions concurrently.
+    Results come back in the same order as the questions.
+    """
+    return await asyncio.gather(*(ask_system(q) for q in questions))
+
 #%%
 ###############################################################################
 # 8) Demo
 ###############################################################################
-def main():
-    # Example usage
+async def main():
+    # Example usage: all queries are submitted at once, so the batch takes
+    # about as long as its slowest query. Repeats still count toward
+    # memoization; on the next run they are answered by virtual tools.
     queries = [
         "John has 3 apples, Mary has 5. Combine them, then multiply the total by 2.",
         "Compute the difference of 10 and 3, then do product with 4.",
         "Compute the difference of 10 and 3, then do product with 4.",  # repeated => triggers storing memo
-        "John has 3 apples, Mary has 5. Combine them, then multiply the total by 2.",  # repeated => uses memo
+        "John has 3 apples, Mary has 5. Combine them, then multiply the total by 2.",  # repeated => memo
         "Compute the difference of 10 and 3, then do product with 4.", 
         "Absolute of -6, then sum 4 to that result."
     ]
-    for q in queries:
+    results = await ask_many(queries)
+    for q, result in zip(queries, results):
         print("\nUser question:", q)
-        result = ask_system(q)
         print("System =>", result)
 
 if __name__ == "__main__":
-    main()
+    asyncio.run(main())
 # %%
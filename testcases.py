@@ -0,0 +1,220 @@
+#!/usr/bin/env python3
+"""
+Behaviour checks for multi_agent_toolbox that need no network or API key.
+
+Usage:
+  python testcases.py
+"""
+#%%
+import asyncio
+import json
+import os
+import tempfile
+import unittest
+from types import SimpleNamespace
+from unittest import mock
+
+# Must be set before import: the module opens its database then.
+os.environ["VIRTUAL_TOOLS_DB"] = os.path.join(tempfile.mkdtemp(), "virtual_tools.db")
+
+import multi_agent_toolbox as mat
+
+def plan_for(question: str):
+    """fast_plan's plan for a question, parsed (None if no template matched)."""
+    plan_text = mat.fast_plan(mat.get_question_signature(question))
+    return None if plan_text is None else json.loads(plan_text)
+
+#%%
+###############################################################################
+# fast_plan: the rule-based planner
+###############################################################################
+class FastPlanTests(unittest.TestCase):
+    def test_demo_questions(self):
+        cases = [
+            ("John has 3 apples, Mary has 5. Combine them, then multiply the total by 2.",
+             [("SUM", [3, 5]), ("PRODUCT", [8, 2])], 16.0),
+            ("Compute the difference of 10 and 3, then do product with 4.",
+             [("DELTA", [3, 10]), ("PRODUCT", [7, 4])], 28.0),
+            ("Absolute of -6, then sum 4 to that result.",
+             [("ABS", [-6]), ("SUM", [6, 4])], 10.0),
+        ]
+        for question, steps, answer in cases:
+            with self.subTest(question=question):
+                plan = plan_for(question)
+                self.assertEqual(
+                    [(s["tool"], s["args"]) for s in plan["steps"]], steps)
+                self.assertEqual(plan["final_step_index"], len(steps) - 1)
+                self.assertEqual(mat.execute_plan(json.dumps(plan)), answer)
+
+    def test_difference_keeps_operand_order(self):
+        # "difference of a and b" is a - b, and DELTA computes args[1] - args[0]
+        plan = plan_for("Compute the difference of 3 and 10, then do product with 4.")
+        self.assertEqual(plan["steps"][0], {"tool": "DELTA", "args": [10, 3]})
+        self.assertEqual(mat.execute_plan(json.dumps(plan)), -28.0)
+
+    def test_single_operations_with_decimals_and_negatives(self):
+        self.assertEqual(mat.execute_plan(json.dumps(plan_for("What is the sum of 2.5 and 4?"))), 6.5)
+        self.assertEqual(mat.execute_plan(json.dumps(plan_for("product of 3 and -2"))), -6.0)
+
+    def test_partial_matches_fall_through(self):
+        for question in [
+            "Compute the difference of 10 and 3, then do product with 4, then divide by 2.",
+            "sum of 3 and 4 then double",
+            "Triple 5, then compute the sum of 3 and 4.",
+            "John has 3 apples, Mary has 5 times as many. Combine them, then multiply the total by 2.",
+            "John has 3 apples and eats 1, Mary has 5. Combine them, then multiply the total by 2.",
+            "John has 3 apples, Bob has 7, Mary has 5. Combine them, then multiply the total by 2.",
+        ]:
+            with self.subTest(question=question):
+                self.assertIsNone(plan_for(question))
+
+#%%
+###############################################################################
+# Semantic lookup: number guard
+###############################################################################
+class NumberGuardTests(unittest.TestCase):
+    def test_numbers_are_compared_in_order(self):
+        a = mat.question_numbers("compute the difference of 10 and 3, then do product with 4.")
+        b = mat.question_numbers("compute the difference of 3 and 10, then do product with 4.")
+        self.assertEqual(a, (10.0, 3.0, 4.0))
+        self.assertNotEqual(a, b)
+
+    def test_reordered_paraphrase_is_not_replayed(self):
+        stored = "compute the difference of 10 and 3, then do product with 4"
+        asked  = "compute the difference of 3 and 10, then do product with 4"
+        vec = mat.np.ones(8, dtype=mat.np.float32) / mat.np.sqrt(8)
+        mat.store_virtual_tool(stored, mat.fast_plan(stored), vec)
+        try:
+            # identical embeddings: only the number guard can reject it
+            self.assertIsNone(mat.find_similar_tool(asked, vec))
+            self.assertEqual(mat.find_similar_tool(stored + "!", vec), stored)
+        finally:
+            mat._unindex(stored)
+
+    def test_number_words_are_compared(self):
+        stored = "add 3 and 5, then double"
+        vec = mat.np.ones(8, dtype=mat.np.float32) / mat.np.sqrt(8)
+        mat.store_virtual_tool(stored, mat.fast_plan("sum of 3 and 5"), vec)
+        try:
+            for asked in ["add 3 and 5, then triple", "add 3 and 5, then halve it",
+                          "add 3 and 5, then square it"]:
+                with self.subTest(asked=asked):
+                    self.assertIsNone(mat.find_similar_tool(asked, vec))
+            self.assertEqual(mat.find_similar_tool("add 3 and 5, then double it", vec), stored)
+        finally:
+            mat._unindex(stored)
+
+#%%
+###############################################################################
+# Virtual tools: LRU eviction and the semantic index
+###############################################################################
+class EvictionTests(unittest.TestCase):
+    def test_hit_protects_from_eviction_and_index_stays_consistent(self):
+        sigs = [f"sum of {i} and 1" for i in range(5)]
+        vecs = {sig: mat.np.eye(8, dtype=mat.np.float32)[i] for i, sig in enumerate(sigs)}
+        with mock.patch.object(mat, "MAX_VIRTUAL_TOOLS", 3):
+            try:
+                for sig in sigs[:3]:
+                    mat.store_virtual_tool(sig, mat.fast_plan(sig), vecs[sig])
+                mat.record_virtual_tool_hit(sigs[0])       # now most recent
+                mat.store_virtual_tool(sigs[3], mat.fast_plan(sigs[3]), vecs[sigs[3]])
+                mat.store_virtual_tool(sigs[4], mat.fast_plan(sigs[4]), vecs[sigs[4]])
+
+                live = [sigs[0], sigs[3], sigs[4]]
+                stored = {sig for (sig,) in mat._db.execute("SELECT sig FROM plans")}
+                self.assertEqual(stored, set(live))
+                for sig in sigs:
+                    self.assertEqual(mat.has_virtual_tool(sig), sig in live)
+
+                self.assertEqual(sorted(mat._vt_sigs), sorted(live))
+                self.assertEqual(len(mat._vt_nums), len(mat._vt_sigs))
+                self.assertEqual(mat._vt_rows, {sig: i for i, sig in enumerate(mat._vt_sigs)})
+                for i, sig in enumerate(mat._vt_sigs):
+                    self.assertEqual(mat._vt_nums[i], mat.question_numbers(sig))
+                    self.assertTrue(mat.np.array_equal(mat._vt_matrix[i], vecs[sig]))
+                for sig in sigs:
+                    self.assertEqual(mat.find_similar_tool(sig, vecs[sig]),
+                                     sig if sig in live else None)
+            finally:
+                for sig in sigs:
+                    mat._unindex(sig)
+
+#%%
+###############################################################################
+# stream_reply: early return on the plan object
+###############################################################################
+class FakeStream:
+    """Async iterator over text pieces, shaped like an OpenAI chunk stream."""
+    def __init__(self, pieces):
+        self.pieces = list(pieces)
+        self.sent = 0
+        self.closed = False
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if self.sent == len(self.pieces):
+            raise StopAsyncIteration
+        self.sent += 1
+        delta = SimpleNamespace(content=self.pieces[self.sent - 1])
+        return SimpleNamespace(choices=[SimpleNamespace(delta=delta)])
+
+    async def close(self):
+        self.closed = True
+
+def fake_client(stream: FakeStream):
+    async def create(**kwargs):
+        return stream
+    return SimpleNamespace(chat=SimpleNamespace(completions=SimpleNamespace(create=create)))
+
+class StreamReplyTests(unittest.TestCase):
+    def reply(self, pieces):
+        stream = FakeStream(pieces)
+        with mock.patch.object(mat, "get_client", return_value=fake_client(stream)):
+            return asyncio.run(mat.stream_reply([])), stream
+
+    def test_returns_once_plan_closes(self):
+        text, stream = self.reply([
+            '{"steps": [{"tool": "SUM", "args": [3, 5]}], ',
+            '"final_step_index": 0}', " and the rest", " is never read"])
+        self.assertEqual(json.loads(text)["final_step_index"], 0)
+        self.assertEqual(stream.sent, 2)
+        self.assertTrue(stream.closed)
+
+    def test_drops_preamble_and_code_fence(self):
+        text, _ = self.reply([
+            'Here is the plan:\n```json\n{"steps": [{"tool": "ABS", ',
+            '"args": [-6]}], "final_step_index": 0}\n```\n'])
+        self.assertEqual(text, '{"steps": [{"tool": "ABS", "args": [-6]}], "final_step_index": 0}')
+
+    def test_braces_inside_strings_are_not_counted(self):
+        plan = {"steps": [{"tool": "ABS", "args": [-6], "note": "}} \"{"}],
+                "final_step_index": 0}
+        body = json.dumps(plan)
+        text, stream = self.reply([body[i:i + 5] for i in range(0, len(body), 5)] + ["tail"])
+        self.assertEqual(json.loads(text), plan)
+        self.assertTrue(stream.closed)
+        self.assertLess(stream.sent, len(stream.pieces))
+
+    def test_reply_without_plan_is_returned_whole(self):
+        text, stream = self.reply(['  {"a": 1} is not', " a plan  "])
+        self.assertEqual(text, '{"a": 1} is not a plan')
+        self.assertTrue(stream.closed)
+
+#%%
+###############################################################################
+# ask_system: lookup order
+###############################################################################
+class AskSystemOrderTests(unittest.TestCase):
+    def test_templated_question_skips_semantic_lookup_and_llm(self):
+        question = "What is the product of 6 and 7?"
+        with mock.patch.object(mat, "semantic_index_ready", return_value=True), \
+             mock.patch.object(mat, "find_similar_tool", side_effect=AssertionError("semantic lookup")), \
+             mock.patch.object(mat, "conversation_with_planner", side_effect=AssertionError("LLM call")):
+            vias = [asyncio.run(mat.ask_system(question))["via"] for _ in range(3)]
+        # 2 successes => memoized, then answered by the virtual tool
+        self.assertEqual(vias, ["fast_plan", "fast_plan", "virtual_tool"])
+
+if __name__ == "__main__":
+    unittest.main()